@@ -1,21 +1,53 @@
 # app/main.py
 import os
-import json
-import signal
+import math
+import html
+import hmac
+import time
+import atexit
+import queue
+import hashlib
+import calendar
 import logging
+import logging.handlers
 import threading
+import concurrent.futures
+import httplib2
+import orjson
 import requests
+from xml.etree import ElementTree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, ResponseError
 from datetime import datetime, timedelta, timezone
-from flask import Flask
+from flask import Flask, request
 from apscheduler.schedulers.background import BackgroundScheduler
-from googleapiclient.discovery import build
+from apscheduler.executors.pool import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+
+# Записи только кладутся в очередь, вывод делает отдельный поток QueueListener
+_log_queue = queue.SimpleQueue()
+_log_handlers = [logging.StreamHandler()]
+if os.getenv("LOG_FILE"):
+    _log_handlers.append(logging.handlers.RotatingFileHandler(
+        os.getenv("LOG_FILE"), maxBytes=5_000_000, backupCount=3, encoding='utf-8', delay=True
+    ))
+for _handler in _log_handlers:
+    _handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
+    format='%(message)s',
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+if os.getenv("DEBUG"):
+    logger.setLevel(logging.DEBUG)
+# APScheduler пишет INFO о каждом запуске задачи, а state_flush запускается раз в минуту
+logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 
 app = Flask(__name__)
 app_lock = threading.Lock()
@@ -25,106 +57,430 @@ class Config:
     TG_CHANNEL = os.getenv("TG_CHANNEL")
     YT_KEY = os.getenv("YT_KEY")
     YT_CHANNEL_ID = os.getenv("YT_CHANNEL_ID")
+    YT_UPLOADS_PLAYLIST = None  # Определяется по YT_CHANNEL_ID при первом опросе
     STATE_FILE = os.path.join(os.path.dirname(__file__), "bot_state.json")
-    CHECK_INTERVAL = 10
+    CHECK_INTERVAL = 10  # Минуты; начальный интервал опроса
+    MIN_CHECK_INTERVAL = 2  # После нового видео опрашиваем чаще
+    MAX_CHECK_INTERVAL = 60  # На тихом канале интервал растёт до этого предела
+    IDLE_POLLS_BEFORE_BACKOFF = 6
+    CHECK_JITTER = 30  # Секунды случайного сдвига, чтобы инстансы не опрашивали синхронно
+    FALLBACK_CHECK_INTERVAL = 6 * 60  # Минуты; страховочный опрос, пока WebSub-подписка подтверждена; заметно меньше MAX_VIDEO_AGE
+    PUBLIC_URL = os.getenv("PUBLIC_URL")  # Внешний адрес сервиса для WebSub-уведомлений
+    HUB_URL = "https://pubsubhubbub.appspot.com/subscribe"
+    HUB_SECRET = os.getenv("HUB_SECRET")  # Обязателен при PUBLIC_URL: без подписи уведомления не принимаются
+    MAX_VIDEO_AGE = 24 * 60 * 60  # Секунды; более старые видео не анонсируются
+    TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "10"))
+    YT_TIMEOUT = int(os.getenv("YT_TIMEOUT", "30"))
+    STATE_FLUSH_INTERVAL = 60  # Секунды; состояние пишется на диск не чаще этого
     PORT = int(os.environ["PORT"])  # Только из переменной окружения
 
 class StateManager:
     def __init__(self):
         self._state = self._load_state()
+        self._dirty = False
+        self._flush_lock = threading.Lock()
     
     def _load_state(self):
         try:
-            with open(Config.STATE_FILE, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {'last_video_id': None, 'initialized': False}
+            with open(Config.STATE_FILE, 'rb') as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return {'last_video_id': None, 'initialized': False, 'etag': None}
     
     def update(self, new_state):
         with app_lock:
-            self._state.update(new_state)
-            with open(Config.STATE_FILE, 'w') as f:
-                json.dump(self._state, f, indent=2)
+            if all(self._state.get(key) == value for key, value in new_state.items()):
+                return
+            state = {**self._state, **new_state}
+            self._state = state
+            self._dirty = True
+    
+    def flush(self):
+        # Запись на диск идёт вне app_lock: снимки состояния неизменяемы
+        with self._flush_lock:
+            with app_lock:
+                if not self._dirty:
+                    return
+                state = self._state
+                self._dirty = False
+            try:
+                data = orjson.dumps(state)
+                tmp_file = Config.STATE_FILE + ".tmp"
+                fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    written = os.write(fd, data)
+                    if written != len(data):
+                        raise OSError(f"Записано {written} из {len(data)} байт в {tmp_file}")
+                finally:
+                    os.close(fd)
+                os.replace(tmp_file, Config.STATE_FILE)
+            except OSError:
+                with app_lock:
+                    self._dirty = True
+                raise
+    
+    @property
+    def last_video_id(self):
+        return self._state.get('last_video_id')
+    
+    @property
+    def initialized(self):
+        return self._state.get('initialized', False)
+    
+    @property
+    def etag(self):
+        return self._state.get('etag')
     
     @property
-    def state(self):
-        return self._state.copy()
+    def check_interval(self):
+        return self._state.get('check_interval', Config.CHECK_INTERVAL)
 
 state_manager = StateManager()
 
 @app.route('/')
 def health_check():
-    logger.info(f"Health check на порту {Config.PORT}")
+    logger.debug("Health check на порту %s", Config.PORT)
     return {"status": "OK", "port": Config.PORT}, 200
 
-def youtube_fetch():
-    youtube = build('youtube', 'v3', developerKey=Config.YT_KEY)
-    return youtube.search().list(
-        part="snippet",
-        channelId=Config.YT_CHANNEL_ID,
+_youtube = None
+_youtube_lock = threading.Lock()
+
+def get_youtube():
+    global _youtube
+    if _youtube is None:
+        # googleapiclient.discovery тяжёлый при импорте, грузим только при первом опросе
+        from googleapiclient.discovery import build
+        with _youtube_lock:
+            if _youtube is None:
+                _youtube = build(
+                    'youtube', 'v3',
+                    developerKey=Config.YT_KEY,
+                    http=httplib2.Http(timeout=Config.YT_TIMEOUT),
+                    cache_discovery=False,
+                    static_discovery=True
+                )
+    return _youtube
+
+def uploads_playlist_id():
+    if Config.YT_UPLOADS_PLAYLIST is None:
+        response = get_youtube().channels().list(
+            part="contentDetails",
+            id=Config.YT_CHANNEL_ID,
+            fields="items/contentDetails/relatedPlaylists/uploads"
+        ).execute()
+        Config.YT_UPLOADS_PLAYLIST = response['items'][0]['contentDetails']['relatedPlaylists']['uploads']
+    return Config.YT_UPLOADS_PLAYLIST
+
+def youtube_fetch(etag=None):
+    yt_request = get_youtube().playlistItems().list(
+        part="snippet,contentDetails",
+        playlistId=uploads_playlist_id(),
         maxResults=1,
-        order="date",
-        type="video"
-    ).execute()
+        fields="etag,items(snippet/title,contentDetails(videoId,videoPublishedAt))"
+    )
+    if etag:
+        yt_request.headers['If-None-Match'] = etag
+    try:
+        return yt_request.execute()
+    except HttpError as e:
+        if e.resp.status == 304:
+            return None
+        raise
+
+class CappedRetry(Retry):
+    # Retry-After дольше retry_after_max не пережидаем, а сразу отдаём ответ вызывающему
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and self.respect_retry_after_header:
+            if self.new(retry_after_max=math.inf).parse_retry_after(retry_after) > self.retry_after_max:
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After {retry_after} больше {self.retry_after_max} с"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+def make_session(pool_maxsize):
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_maxsize,
+        max_retries=CappedRetry(
+            total=3,
+            # После таймаута чтения Telegram мог уже опубликовать сообщение — не повторяем
+            read=0,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # sendMessage — это POST, по умолчанию urllib3 его не повторяет
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            respect_retry_after_header=True,
+            # Flood-wait не должен надолго занимать notify_lock и поток планировщика;
+            # при более долгом Retry-After CappedRetry не повторяет запрос вовсе
+            retry_after_max=30,
+            raise_on_status=False
+        )
+    ))
+    atexit.register(session.close)
+    return session
+
+_tg_session = make_session(pool_maxsize=Config.TG_POOL_SIZE)
+_TG_URL = f"https://api.telegram.org/bot{Config.TG_TOKEN}/sendMessage"
+_MSG_TEMPLATE = "🎥 Новое видео!\n<b>{title}</b>\nhttps://youtu.be/{id}"
+_TG_BASE_PAYLOAD = {'chat_id': Config.TG_CHANNEL, 'parse_mode': 'HTML'}
 
 def telegram_send(video_data):
-    response = requests.post(
-        f"https://api.telegram.org/bot{Config.TG_TOKEN}/sendMessage",
-        json={
-            'chat_id': Config.TG_CHANNEL,
-            'text': f"🎥 Новое видео!\n<b>{video_data['title']}</b>\nhttps://youtu.be/{video_data['id']}",
-            'parse_mode': 'HTML'
-        },
-        timeout=15
+    response = _tg_session.post(
+        _TG_URL,
+        json={**_TG_BASE_PAYLOAD, 'text': _MSG_TEMPLATE.format_map(video_data)},
+        timeout=(5, 15)
     )
+    if not response.ok:
+        logger.error("Telegram ответил %s: %s", response.status_code, response.text[:200])
     return response.ok
 
+def parse_published(value):
+    # YouTube всегда отдаёт время в виде YYYY-MM-DDTHH:MM:SSZ; возвращаем Unix-время
+    return calendar.timegm((
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19])
+    ))
+
+notify_lock = threading.Lock()
+_recent_alerts = {}  # video_id -> время отправки; защищает от повторных анонсов
+_io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="io")
+atexit.register(_io_pool.shutdown)
+
+def notify_video(video_id, title, published):
+    # Общая точка для опроса и WebSub; "sent" — уведомление отправлено, False — не доставлено
+    with notify_lock:
+        if time.time() - published > Config.MAX_VIDEO_AGE:
+            return True
+
+        if not state_manager.initialized:
+            state_manager.update({'last_video_id': video_id, 'initialized': True})
+            logger.info("Инициализировано начальное состояние")
+            return True
+
+        if video_id == state_manager.last_video_id or video_id in _recent_alerts:
+            return True
+
+        # Сообщение уходит с parse_mode=HTML: "Q&A" или "<3" без экранирования Telegram отвергает
+        if not telegram_send({'id': video_id, 'title': html.escape(title or "")}):
+            return False
+        now = time.time()
+        for sent_id, sent_at in list(_recent_alerts.items()):
+            if now - sent_at > Config.MAX_VIDEO_AGE:
+                del _recent_alerts[sent_id]
+        _recent_alerts[video_id] = now
+        state_manager.update({'last_video_id': video_id})
+        logger.info("Отправлено уведомление для видео %s", video_id)
+        return "sent"
+
 def check_task():
-    with app_lock:
-        try:
-            data = youtube_fetch()
-            video = data['items'][0]
-            video_id = video['id']['videoId']
-            published = datetime.fromisoformat(video['snippet']['publishedAt'].rstrip('Z') + '+00:00')
-            
-            if (datetime.now(timezone.utc) - published) > timedelta(hours=24):
-                return
+    try:
+        data = youtube_fetch(state_manager.etag)
+        if data is None:
+            adapt_check_interval(found_new=False)
+            return
+        items = data.get('items')
+        if not items:
+            return
+        video = items[0]
+        details = video.get('contentDetails') or {}
+        video_id = details.get('videoId')
+        published = details.get('videoPublishedAt')
+        if not (video_id and published):
+            return
+        title = (video.get('snippet') or {}).get('title', "")
+        result = notify_video(video_id, title, parse_published(published))
+        if result:
+            state_manager.update({'etag': data.get('etag')})
+            adapt_check_interval(found_new=result == "sent")
+    except (HttpError, httplib2.HttpLib2Error, requests.RequestException, OSError) as e:
+        logger.error("Ошибка в задаче: %s", e)
 
-            if not state_manager.state['initialized']:
-                state_manager.update({'last_video_id': video_id, 'initialized': True})
-                logger.info("Инициализировано начальное состояние")
-                return
+_push_active = False
+_subscribe_pending = False  # Ждём от хаба подтверждения запроса, отправленного hub_subscribe
+_idle_polls = 0
+
+_YT_TOPIC = f"https://www.youtube.com/xml/feeds/videos.xml?channel_id={Config.YT_CHANNEL_ID}"
+_ATOM_NS = {'atom': 'http://www.w3.org/2005/Atom', 'yt': 'http://www.youtube.com/xml/schemas/2015'}
+# Токен в адресе callback: без него запросы к /yt/webhook пришли не от нашей подписки.
+# Выводится из HUB_SECRET, поэтому не меняется между перезапусками.
+_HUB_TOKEN = (
+    hmac.new(Config.HUB_SECRET.encode(), _YT_TOPIC.encode(), hashlib.sha256).hexdigest()
+    if Config.HUB_SECRET else None
+)
+
+def hub_token_valid(token):
+    return _HUB_TOKEN is not None and hmac.compare_digest(_HUB_TOKEN.encode(), (token or "").encode())
+
+def hub_signature_valid(body, signature):
+    if not Config.HUB_SECRET:
+        return False
+    expected = "sha1=" + hmac.new(Config.HUB_SECRET.encode(), body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest(expected.encode(), (signature or "").encode())
+
+@app.route('/yt/webhook', methods=['GET', 'POST'])
+def youtube_webhook():
+    global _push_active, _subscribe_pending
+    if not hub_token_valid(request.args.get('token')):
+        return "", 404
+
+    if request.method == 'GET':
+        if request.args.get('hub.topic') != _YT_TOPIC:
+            return "", 404
+        mode = request.args.get('hub.mode')
+        if mode == 'denied':
+            logger.error("Хаб отклонил подписку WebSub: %s", request.args.get('hub.reason', ""))
+            _subscribe_pending = False
+            _push_active = False
+            set_check_interval(state_manager.check_interval)
+            return "", 200
+        # Отписку мы никогда не запрашиваем, поэтому подтверждаем только свой запрос подписки
+        if mode != 'subscribe' or not _subscribe_pending:
+            return "", 404
+        logger.info("Подписка WebSub подтверждена")
+        _subscribe_pending = False
+        _push_active = True
+        set_check_interval(Config.FALLBACK_CHECK_INTERVAL)
+        return request.args.get('hub.challenge', ""), 200
+
+    body = request.get_data()
+    if not hub_signature_valid(body, request.headers.get('X-Hub-Signature')):
+        logger.warning("WebSub: неверная подпись уведомления")
+        return "", 204
+    try:
+        feed = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return "", 400
+
+    videos = []
+    channel_id = Config.YT_CHANNEL_ID
+    for entry in feed.findall('atom:entry', _ATOM_NS):
+        findtext = entry.findtext
+        video_id = findtext('yt:videoId', namespaces=_ATOM_NS)
+        published = findtext('atom:published', namespaces=_ATOM_NS)
+        if findtext('yt:channelId', namespaces=_ATOM_NS) != channel_id or not (video_id and published):
+            continue
+        videos.append((video_id, findtext('atom:title', namespaces=_ATOM_NS), parse_published(published)))
+    if videos:
+        # Хабу отвечаем сразу, отправка в Telegram идёт в фоне
+        _io_pool.submit(notify_videos, videos)
+    return "", 204
 
-            if video_id != state_manager.state['last_video_id']:
-                if telegram_send({'id': video_id, 'title': video['snippet']['title']}):
-                    state_manager.update({'last_video_id': video_id})
-                    logger.info(f"Отправлено уведомление для видео {video_id}")
-        except Exception as e:
-            logger.error(f"Ошибка в задаче: {str(e)}", exc_info=True)
+def notify_videos(videos):
+    global _push_active
+    try:
+        for video_id, title, published in videos:
+            if not notify_video(video_id, title, published):
+                break
+        else:
+            return
+    except requests.RequestException as e:
+        logger.error("Ошибка отправки в Telegram: %s", e)
+    except Exception as e:
+        logger.error("Ошибка обработки WebSub-уведомления: %s", e, exc_info=True)
+    # Хаб это уведомление больше не пришлёт: недоставленное видео подбирает опрос,
+    # поэтому выходим из режима WebSub и опрашиваем сразу
+    _push_active = False
+    set_check_interval(state_manager.check_interval)
+    job = scheduler.get_job('check_task')
+    if job is not None:
+        job.modify(next_run_time=datetime.now(timezone.utc))
 
-scheduler = BackgroundScheduler()
+def hub_subscribe():
+    global _push_active, _subscribe_pending
+    if not Config.HUB_SECRET:
+        logger.error("WebSub не включён: задайте HUB_SECRET вместе с PUBLIC_URL")
+        return
+    data = {
+        'hub.callback': f"{Config.PUBLIC_URL.rstrip('/')}/yt/webhook?token={_HUB_TOKEN}",
+        'hub.topic': _YT_TOPIC,
+        'hub.mode': 'subscribe',
+        'hub.verify': 'async',
+        'hub.secret': Config.HUB_SECRET
+    }
+    # Флаг ставим до запроса: хаб может прислать проверку раньше, чем ответит нам
+    _subscribe_pending = True
+    try:
+        response = requests.post(Config.HUB_URL, data=data, timeout=(5, 15))
+        if response.ok:
+            logger.info("Отправлен запрос на подписку WebSub")
+            return
+        logger.error("Подписка WebSub отклонена: %s %s", response.status_code, response.text)
+    except requests.RequestException as e:
+        logger.error("Ошибка подписки WebSub: %s", e)
+    # Без подписки возвращаемся к обычному опросу
+    _subscribe_pending = False
+    _push_active = False
+    set_check_interval(state_manager.check_interval)
 
-def shutdown_handler(signum, frame):
+def set_check_interval(minutes):
+    job = scheduler.get_job('check_task')
+    if job is not None and job.trigger.interval != timedelta(minutes=minutes):
+        scheduler.reschedule_job('check_task', trigger='interval', minutes=minutes, jitter=Config.CHECK_JITTER)
+        logger.info("Интервал проверки изменён на %s мин", minutes)
+
+def adapt_check_interval(found_new):
+    # Пока работает WebSub, опрос остаётся страховочным и не подстраивается
+    global _idle_polls
+    if _push_active:
+        return
+    if found_new:
+        _idle_polls = 0
+        interval = Config.MIN_CHECK_INTERVAL
+    else:
+        _idle_polls += 1
+        if _idle_polls < Config.IDLE_POLLS_BEFORE_BACKOFF:
+            return
+        _idle_polls = 0
+        current = state_manager.check_interval
+        interval = min(Config.MAX_CHECK_INTERVAL, max(current + 1, int(current * 1.5)))
+    state_manager.update({'check_interval': interval})
+    set_check_interval(interval)
+
+scheduler = BackgroundScheduler(
+    executors={'default': ThreadPoolExecutor(max_workers=1)},
+    job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300}
+)
+
+def shutdown_handler():
     logger.info("Завершение работы...")
-    scheduler.shutdown()
+    if scheduler.running:
+        scheduler.shutdown()
+    state_manager.flush()
+    _tg_session.close()
 
 def create_app():
-    if os.environ.get("GUNICORN_WORKER") != "true":
-        signal.signal(signal.SIGTERM, shutdown_handler)
-        signal.signal(signal.SIGINT, shutdown_handler)
-        
+    # Сигналы обрабатывает gunicorn; при выходе воркера сработает atexit.
+    # Планировщик должен жить ровно в одном процессе, поэтому --workers 1.
+    # Повторный вызов create_app не должен добавлять задачи второй раз
+    if os.environ.get("GUNICORN_WORKER") != "true" and not scheduler.running:
+        atexit.register(shutdown_handler)
+
+        if Config.PUBLIC_URL:
+            # Подписку продлеваем раз в сутки; до подтверждения хабом опрашиваем как обычно
+            scheduler.add_job(
+                hub_subscribe,
+                'interval',
+                id='hub_subscribe',
+                hours=24,
+                next_run_time=datetime.now(timezone.utc)
+            )
+
+        scheduler.add_job(
+            state_manager.flush,
+            'interval',
+            id='state_flush',
+            seconds=Config.STATE_FLUSH_INTERVAL
+        )
+
         scheduler.add_job(
             check_task,
             'interval',
-            minutes=Config.CHECK_INTERVAL,
-            misfire_grace_time=300
+            id='check_task',
+            minutes=state_manager.check_interval,
+            jitter=Config.CHECK_JITTER,
+            next_run_time=datetime.now(timezone.utc)
         )
         scheduler.start()
-        check_task()
-        logger.info(f"Приложение запущено на порту {Config.PORT}")
+        logger.info("Приложение запущено на порту %s", Config.PORT)
     
     return app
-
-if __name__ == "__main__":
-    app = create_app()
-    app.run(host='0.0.0.0', port=Config.PORT)